@@ -1,21 +1,44 @@
- from unittest.mock import patch
+import asyncio
+from unittest.mock import patch
 from dotenv import load_dotenv
 import os
+import httpx
 import pytest
-from pytest_httpx import HTTPXMock
+import pytest_asyncio
+import respx
 
 load_dotenv()
 
 API_KEY = os.getenv("OWM_API_KEY")
+OWM_API_BASE = "https://api.openweathermap.org/data/2.5"
 
+
+def owm_params(**params):
+    """Expected query params, including the ones the shared client adds."""
+    return {**params, "appid": API_KEY, "units": "metric"}
+
+
+import weather
 from weather import (
+    _close_client,
+    _get_client,
+    _owm_cache,
     format_alert,
     make_owm_request,
     get_alerts,
-    get_forecast
+    get_forecast,
+    serve
 )
 
 
+@pytest_asyncio.fixture(autouse=True)
+async def reset_client():
+    # The shared client is bound to the event loop it was created on
+    _owm_cache.clear()
+    yield
+    await _close_client()
+
+
 # API Request Fixtures
 @pytest.fixture
 def sample_weather_response():
@@ -36,6 +59,14 @@ def sample_weather_response():
     }
 
 
+@pytest.fixture
+def sample_group_response(sample_weather_response):
+    return {
+        "cnt": 3,
+        "list": [sample_weather_response] * 3
+    }
+
+
 @pytest.fixture
 def sample_forecast_response():
     return {
@@ -61,44 +92,96 @@ def sample_forecast_response():
 
 # API Request Tests
 @pytest.mark.asyncio
-async def test_make_owm_request_success(httpx_mock: HTTPXMock):
-    test_url = "https://api.openweathermap.org/data/2.5/weather"
+@respx.mock
+async def test_make_owm_request_success():
+    test_url = f"{OWM_API_BASE}/weather"
     test_params = {"q": "TestCity"}
     expected_response = {"status": "success"}
 
-    # Add URL matching while keeping the simple structure that worked
-    httpx_mock.add_response(
-        url=f"{test_url}?q=TestCity&appid={API_KEY}&units=metric",
-        json=expected_response
+    route = respx.get(test_url, params=owm_params(q="TestCity")).mock(
+        return_value=httpx.Response(200, json=expected_response)
     )
 
-    # Add request inspection for debugging
-    result = await make_owm_request(test_url, test_params)
-
-    # Get the request(s) made to our mock
-    requests = httpx_mock.get_requests()
-    print(f"Requests made: {[r.url for r in requests]}")
+    result = await make_owm_request("/weather", test_params)
 
-    assert len(requests) == 1
-    assert str(requests[0].url).startswith(test_url)
+    assert route.call_count == 1
+    assert str(route.calls.last.request.url).startswith(test_url)
 
     assert result == expected_response
+    assert test_params == {"q": "TestCity"}  # Caller's params are left untouched
 
 
 @pytest.mark.asyncio
-async def test_make_owm_request_timeout(httpx_mock: HTTPXMock):
-    test_url = "https://api.openweathermap.org/data/2.5/weather"
+@respx.mock
+async def test_make_owm_request_timeout():
     test_params = {"q": "TestCity"}
 
-    httpx_mock.add_exception(
-        url=f"{test_url}?q=TestCity&appid={API_KEY}&units=metric",
-        exception=TimeoutError()
+    respx.get(f"{OWM_API_BASE}/weather", params=owm_params(q="TestCity")).mock(
+        side_effect=httpx.ReadTimeout("Request timed out")
     )
 
-    result = await make_owm_request(test_url, test_params)
+    result = await make_owm_request("/weather", test_params)
     assert result is None
 
 
+@pytest.mark.asyncio
+@respx.mock
+async def test_make_owm_request_cached():
+    expected_response = {"status": "success"}
+
+    route = respx.get(f"{OWM_API_BASE}/weather", params=owm_params(q="TestCity")).mock(
+        return_value=httpx.Response(200, json=expected_response)
+    )
+
+    first = await make_owm_request("/weather", {"q": "TestCity"})
+    second = await make_owm_request("/weather", {"q": "TestCity"})
+
+    assert first == second == expected_response
+    assert route.call_count == 1
+
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_make_owm_request_coalesces_concurrent_calls():
+    expected_response = {"status": "success"}
+
+    route = respx.get(f"{OWM_API_BASE}/weather", params=owm_params(q="TestCity")).mock(
+        return_value=httpx.Response(200, json=expected_response)
+    )
+
+    results = await asyncio.gather(
+        *(make_owm_request("/weather", {"q": "TestCity"}) for _ in range(3))
+    )
+
+    assert results == [expected_response] * 3
+    assert route.call_count == 1
+
+
+@pytest.mark.asyncio
+@respx.mock
+async def test_make_owm_request_revalidates_with_etag():
+    expected_response = {"status": "success"}
+
+    # max-age=0 makes the cached entry stale immediately
+    route = respx.get(f"{OWM_API_BASE}/weather", params=owm_params(q="TestCity")).mock(
+        side_effect=[
+            httpx.Response(
+                200,
+                json=expected_response,
+                headers={"ETag": '"abc"', "Cache-Control": "max-age=0"}
+            ),
+            httpx.Response(304),
+        ]
+    )
+
+    first = await make_owm_request("/weather", {"q": "TestCity"})
+    second = await make_owm_request("/weather", {"q": "TestCity"})
+
+    assert first == second == expected_response
+    assert route.call_count == 2
+    assert route.calls.last.request.headers["If-None-Match"] == '"abc"'
+
+
 # Alert Formatting Tests
 def test_format_alert_extreme_heat(sample_weather_response):
     sample_weather_response["main"]["temp"] = 36.0  # Above 35°C
@@ -140,20 +223,39 @@ def test_format_alert_no_alert_needed(sample_weather_response):
 
 # Get Alerts Tests
 @pytest.mark.asyncio
-async def test_get_alerts_success(httpx_mock: HTTPXMock, sample_weather_response):
-    for city in ["Los Angeles", "San Francisco", "Sacramento"]:
-        httpx_mock.add_response(
-            url=f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={API_KEY}&units=metric",
-            json=sample_weather_response
-        )
+@respx.mock
+async def test_get_alerts_success(sample_group_response):
+    route = respx.get(
+        f"{OWM_API_BASE}/group", params=owm_params(id="5368361,5391959,5389489")
+    ).mock(return_value=httpx.Response(200, json=sample_group_response))
 
     result = await get_alerts("CA")
+    assert route.call_count == 1
     assert "Test City" in result
     assert "Thunderstorm" in result
     assert "35.5°C" in result
     assert "7.5 m/s" in result
 
 
+@pytest.mark.asyncio
+@respx.mock
+async def test_get_alerts_batches_large_states(monkeypatch, sample_weather_response):
+    city_ids = tuple(range(1, 22))  # One more than a single /group request allows
+    monkeypatch.setitem(weather.STATE_CITY_IDS, "TX", city_ids)
+
+    first_batch = respx.get(
+        f"{OWM_API_BASE}/group", params=owm_params(id=",".join(map(str, city_ids[:20])))
+    ).mock(return_value=httpx.Response(200, json={"cnt": 20, "list": []}))
+    second_batch = respx.get(
+        f"{OWM_API_BASE}/group", params=owm_params(id="21")
+    ).mock(return_value=httpx.Response(200, json={"cnt": 1, "list": [sample_weather_response]}))
+
+    result = await get_alerts("TX")
+    assert first_batch.call_count == 1
+    assert second_batch.call_count == 1
+    assert "Test City" in result
+
+
 @pytest.mark.asyncio
 async def test_get_alerts_invalid_state():
     result = await get_alerts("XX")
@@ -161,7 +263,8 @@ async def test_get_alerts_invalid_state():
 
 
 @pytest.mark.asyncio
-async def test_get_alerts_no_severe_weather(httpx_mock: HTTPXMock, sample_weather_response):
+@respx.mock
+async def test_get_alerts_no_severe_weather(sample_weather_response, sample_group_response):
     # Update both main and description to be consistent
     sample_weather_response["weather"][0].update({
         "main": "Clear",
@@ -169,11 +272,9 @@ async def test_get_alerts_no_severe_weather(httpx_mock: HTTPXMock, sample_weathe
     })
     sample_weather_response["main"]["temp"] = 20.0  # Normal temperature
 
-    for city in ["Los Angeles", "San Francisco", "Sacramento"]:
-        httpx_mock.add_response(
-            url=f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={API_KEY}&units=metric",
-            json=sample_weather_response
-        )
+    respx.get(
+        f"{OWM_API_BASE}/group", params=owm_params(id="5368361,5391959,5389489")
+    ).mock(return_value=httpx.Response(200, json=sample_group_response))
 
     result = await get_alerts("CA")
     assert "No severe weather alerts" in result
@@ -181,11 +282,11 @@ async def test_get_alerts_no_severe_weather(httpx_mock: HTTPXMock, sample_weathe
 
 # Get Forecast Tests
 @pytest.mark.asyncio
-async def test_get_forecast_success(httpx_mock: HTTPXMock, sample_forecast_response):
+@respx.mock
+async def test_get_forecast_success(sample_forecast_response):
     lat, lon = 34.0522, -118.2437
-    httpx_mock.add_response(
-        url=f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={API_KEY}&units=metric",
-        json=sample_forecast_response
+    respx.get(f"{OWM_API_BASE}/forecast", params=owm_params(lat=lat, lon=lon, cnt=5)).mock(
+        return_value=httpx.Response(200, json=sample_forecast_response)
     )
 
     result = await get_forecast(lat, lon)
@@ -196,11 +297,11 @@ async def test_get_forecast_success(httpx_mock: HTTPXMock, sample_forecast_respo
 
 
 @pytest.mark.asyncio
-async def test_get_forecast_failed_request(httpx_mock: HTTPXMock):
+@respx.mock
+async def test_get_forecast_failed_request():
     lat, lon = 34.0522, -118.2437
-    httpx_mock.add_response(
-        url=f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={API_KEY}&units=metric",
-        status_code=500
+    respx.get(f"{OWM_API_BASE}/forecast", params=owm_params(lat=lat, lon=lon, cnt=5)).mock(
+        return_value=httpx.Response(500)
     )
 
     result = await get_forecast(lat, lon)
@@ -219,14 +320,24 @@ def test_format_alert_missing_data():
 
 
 @pytest.mark.asyncio
-async def test_make_owm_request_invalid_json(httpx_mock: HTTPXMock):
-    test_url = "https://api.openweathermap.org/data/2.5/weather"
+@respx.mock
+async def test_make_owm_request_invalid_json():
     test_params = {"q": "TestCity"}
 
-    httpx_mock.add_response(
-        url=f"{test_url}?q=TestCity&appid={API_KEY}&units=metric",
-        content=b"Invalid JSON"
+    respx.get(f"{OWM_API_BASE}/weather", params=owm_params(q="TestCity")).mock(
+        return_value=httpx.Response(200, content=b"Invalid JSON")
     )
 
-    result = await make_owm_request(test_url, test_params)
+    result = await make_owm_request("/weather", test_params)
     assert result is None
+
+
+@pytest.mark.asyncio
+async def test_serve_closes_client_on_shutdown():
+    async def fake_run_stdio():
+        await _get_client()
+
+    with patch.object(weather.mcp, "run_stdio_async", fake_run_stdio):
+        await serve()
+
+    assert weather._client is None
@@ -1,6 +1,11 @@
+import asyncio
 import os
+import re
+import time
 from typing import Any
 import httpx
+import orjson
+from cachetools import LRUCache
 from dotenv import load_dotenv
 from mcp.server.fastmcp import FastMCP
 
@@ -12,70 +17,220 @@ mcp = FastMCP("weather")
 # Constants
 OWM_API_BASE = "https://api.openweathermap.org/data/2.5"
 API_KEY = os.getenv("OWM_API_KEY")
+OWM_GROUP_MAX_IDS = 20  # The /group endpoint accepts at most 20 city IDs per request
+FORECAST_PERIODS = 5  # Number of 3-hour forecast periods to show
+MAX_CONCURRENT_REQUESTS = 10  # Caps requests in flight to OWM
+
+# OpenWeatherMap city IDs of major cities per state for sampling weather conditions
+STATE_CITY_IDS: dict[str, tuple[int, ...]] = {
+    "CA": (5368361, 5391959, 5389489),  # Los Angeles, San Francisco, Sacramento
+    "NY": (5128581, 5110629, 5106834),  # New York, Buffalo, Albany
+    # Add more states and cities as needed
+}
+
+# Severe weather keywords matched against the condition name and description
+SEVERE_WEATHER_TYPES = {
+    "thunderstorm": "Thunderstorm",
+    "tornado": "Tornado",
+    "hurricane": "Hurricane",
+    "snow": "Heavy Snow",
+}
+_SEVERE_RE = re.compile("|".join(SEVERE_WEATHER_TYPES), re.IGNORECASE)
+
+# OWM data only changes every few minutes, so recent responses are served from memory.
+# Entries are (data, etag, expires_at); stale entries with an ETag are revalidated
+# with a conditional request instead of being downloaded again.
+CACHE_TTL = 300  # seconds, used when the response carries no max-age
+_CacheEntry = tuple[dict[str, Any], str | None, float]
+_owm_cache: LRUCache = LRUCache(maxsize=1024)
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+# In-flight fetches by cache key, so concurrent misses share a single request
+_owm_inflight: dict[tuple, asyncio.Task] = {}
+
+# Bounds the number of requests in flight to OWM at any time
+_owm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Shared HTTP/2 client, created lazily so concurrent requests multiplex over one connection
+_client: httpx.AsyncClient | None = None
+
+
+async def _get_client() -> httpx.AsyncClient:
+    """Return the shared OpenWeatherMap client, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=OWM_API_BASE,
+            # Temperature in Celsius and wind speed in meter/sec
+            params={"appid": API_KEY, "units": "metric"},
+            http2=True,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+        )
+    return _client
+
+
+async def _close_client() -> None:
+    """Close the shared client and release its pooled connections."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def make_owm_request(path: str, params: dict) -> dict[str, Any] | None:
+    """Make a request to the OpenWeatherMap API, serving recent responses from cache.
+
+    ``path`` is relative to OWM_API_BASE; the API key and units are added by the
+    shared client. Concurrent misses for the same request await one shared fetch,
+    so at most one request per URL is outstanding at any time.
+    """
+    key = (path, tuple(sorted(params.items())))
+    entry = _owm_cache.get(key)
+    if (cached := _fresh_data(entry)) is not None:
+        return cached
+
+    if (task := _owm_inflight.get(key)) is None:
+        task = asyncio.create_task(_refresh_owm(key, path, params, entry))
+        _owm_inflight[key] = task
+        task.add_done_callback(lambda _: _owm_inflight.pop(key, None))
+    # Shield the shared fetch so one caller being cancelled doesn't fail the others
+    return await asyncio.shield(task)
+
+
+async def _refresh_owm(
+    key: tuple, path: str, params: dict, stale: _CacheEntry | None
+) -> dict[str, Any] | None:
+    """Fetch a fresh response and store it in the cache."""
+    entry = await _fetch_owm(path, params, stale)
+    if entry is None:
+        return None
+    _owm_cache[key] = entry
+    return entry[0]
+
+
+def _fresh_data(entry: _CacheEntry | None) -> dict[str, Any] | None:
+    """Return the cached data if the entry has not expired yet."""
+    if entry is not None and entry[2] > time.monotonic():
+        return entry[0]
+    return None
 
 
-async def make_owm_request(url: str, params: dict) -> dict[str, Any] | None:
-    """Make a request to the OpenWeatherMap API with error handling."""
-    params["appid"] = API_KEY
-    params["units"] = "metric"  # Temperature in Celsius and wind speed in meter/sec
+def _max_age(headers: httpx.Headers) -> int:
+    """Return how long a response stays fresh, from Cache-Control or the default TTL."""
+    match = _MAX_AGE_RE.search(headers.get("Cache-Control", ""))
+    return int(match.group(1)) if match else CACHE_TTL
 
-    async with httpx.AsyncClient() as client:
+
+async def _fetch_owm(
+    path: str, params: dict, stale: _CacheEntry | None = None
+) -> _CacheEntry | None:
+    """Fetch a response from the OpenWeatherMap API with error handling.
+
+    If a stale cache entry with an ETag is given the request is made conditional,
+    and a 304 Not Modified reuses the cached data with a refreshed expiry.
+    """
+    headers = {"If-None-Match": stale[1]} if stale and stale[1] else None
+    client = await _get_client()
+    async with _owm_semaphore:
         try:
-            response = await client.get(url, params=params, timeout=30.0)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
+            response = await client.get(path, params=params, headers=headers)
+        except httpx.HTTPError:
             return None
 
+    expires_at = time.monotonic() + _max_age(response.headers)
+    if response.status_code == 304 and headers:
+        return stale[0], stale[1], expires_at
+    if response.is_error:
+        return None
+    try:
+        data = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return None
+    return data, response.headers.get("ETag"), expires_at
+
 
 def format_alert(weather_data: dict) -> str | None:
     """Format severe weather conditions into an alert-style message."""
     if not weather_data:
         return None
 
-    # Check for severe conditions
-    main = weather_data.get("weather", [{}])[0]
-    temp = weather_data.get("main", {})
+    # Look up each field once; OWM omits blocks that have no data
+    main = (weather_data.get("weather") or [{}])[0]
+    temp = weather_data.get("main") or {}
     current_temp = temp.get("temp")
+    description = main.get("description")
 
     severe_conditions = []
 
     # Check temperature extremes only if temperature data is available
     if current_temp is not None:
-        if temp.get("temp") > 35:  # Extreme heat threshold in Celsius
+        if current_temp > 35:  # Extreme heat threshold in Celsius
             severe_conditions.append("Extreme Heat")
-        elif temp.get("temp") < 0:  # Freezing point in Celsius
+        elif current_temp < 0:  # Freezing point in Celsius
             severe_conditions.append("Freezing Conditions")
 
     # Check severe weather types
-    severe_weather_types = {
-        "thunderstorm": "Thunderstorm",
-        "tornado": "Tornado",
-        "hurricane": "Hurricane",
-        "snow": "Heavy Snow",
-    }
-
-    weather_id = str(main.get("id", ""))
-    weather_main = main.get("main", "").lower()
-
-    for key, alert_type in severe_weather_types.items():
-        if key in weather_main or key in main.get("description", "").lower():
-            severe_conditions.append(alert_type)
+    text = f"{main.get('main') or ''} {description or ''}"
+    matches = {m.lower() for m in _SEVERE_RE.findall(text)}
+    severe_conditions.extend(
+        alert_type for key, alert_type in SEVERE_WEATHER_TYPES.items() if key in matches
+    )
 
     if not severe_conditions:
         return None
 
-    return f"""
-Severe Weather Alert
-Conditions: {', '.join(severe_conditions)}
-Location: {weather_data.get('name', 'Unknown')}
-Temperature: {temp.get('temp')}°C
-Description: {main.get('description', 'No description available')}
-Humidity: {temp.get('humidity')}%
-Wind Speed: {weather_data.get('wind', {}).get('speed')} m/s
+    return "\n".join((
+        "",
+        "Severe Weather Alert",
+        f"Conditions: {', '.join(severe_conditions)}",
+        f"Location: {weather_data.get('name', 'Unknown')}",
+        f"Temperature: {current_temp}°C",
+        f"Description: {description if description is not None else 'No description available'}",
+        f"Humidity: {temp.get('humidity')}%",
+        f"Wind Speed: {(weather_data.get('wind') or {}).get('speed')} m/s",
+        "",
+    ))
+
+
+FORECAST_PERIOD_TEMPLATE = """
+Time: {dt_txt}
+Temperature: {main[temp]}°C
+Feels Like: {main[feels_like]}°C
+Conditions: {weather[0][main]} - {weather[0][description]}
+Humidity: {main[humidity]}%
+Wind: {wind[speed]} m/s
 """
 
 
+def format_period(period: dict) -> str:
+    """Format a single forecast period from the OWM /forecast response."""
+    return FORECAST_PERIOD_TEMPLATE.format_map(period)
+
+
+def _resolve_city_ids(state: str) -> tuple[int, ...] | None:
+    """Return the OWM city IDs sampled for a state, or None if it isn't supported."""
+    return STATE_CITY_IDS.get(state.upper())
+
+
+async def _fetch_alerts(city_ids: tuple[int, ...]) -> list[str]:
+    """Fetch current weather for the given cities and return any severe weather alerts."""
+    # Fetch cities in batch requests, running the batches concurrently
+    async with asyncio.TaskGroup() as tg:
+        tasks = [
+            tg.create_task(make_owm_request("/group", {
+                "id": ",".join(map(str, city_ids[i:i + OWM_GROUP_MAX_IDS]))
+            }))
+            for i in range(0, len(city_ids), OWM_GROUP_MAX_IDS)
+        ]
+
+    alerts = []
+    for task in tasks:
+        for city_data in (task.result() or {}).get("list", []):
+            if alert := format_alert(city_data):
+                alerts.append(alert)
+    return alerts
+
+
 @mcp.tool()
 async def get_alerts(state: str) -> str:
     """Get weather alerts for a US state.
@@ -83,25 +238,11 @@ async def get_alerts(state: str) -> str:
     Args:
         state: Two-letter US state code (e.g. CA, NY)
     """
-    # Map of major cities per state for sampling weather conditions
-    state_cities = {
-        "CA": ["Los Angeles", "San Francisco", "Sacramento"],
-        "NY": ["New York", "Buffalo", "Albany"],
-        # Add more states and cities as needed
-    }
-
-    cities = state_cities.get(state.upper(), [])
-    if not cities:
-        return f"State {state} not supported yet. Please add cities to the state_cities mapping."
-
-    alerts = []
-    for city in cities:
-        url = f"{OWM_API_BASE}/weather"
-        data = await make_owm_request(url, {"q": city})
-
-        if alert := format_alert(data):
-            alerts.append(alert)
+    city_ids = _resolve_city_ids(state)
+    if not city_ids:
+        return f"State {state} not supported yet. Please add cities to the STATE_CITY_IDS mapping."
 
+    alerts = await _fetch_alerts(city_ids)
     if not alerts:
         return f"No severe weather alerts for {state}"
 
@@ -116,33 +257,28 @@ async def get_forecast(latitude: float, longitude: float) -> str:
         latitude: Latitude of the location
         longitude: Longitude of the location
     """
-    url = f"{OWM_API_BASE}/forecast"
-    data = await make_owm_request(url, {
+    # cnt asks OWM to return only the periods we show instead of all 40
+    data = await make_owm_request("/forecast", {
         "lat": latitude,
-        "lon": longitude
+        "lon": longitude,
+        "cnt": FORECAST_PERIODS
     })
 
     if not data or "list" not in data:
         return "Unable to fetch forecast data for this location."
 
-    # Format the periods into a readable forecast
-    forecasts = []
-    for period in data["list"][:5]:  # Show next 5 periods
-        main = period["main"]
-        weather = period["weather"][0]
-
-        forecast = f"""
-Time: {period['dt_txt']}
-Temperature: {main['temp']}°C
-Feels Like: {main['feels_like']}°C
-Conditions: {weather['main']} - {weather['description']}
-Humidity: {main['humidity']}%
-Wind: {period['wind']['speed']} m/s
-"""
-        forecasts.append(forecast)
+    # Format the next periods into a readable forecast
+    return "\n---\n".join(map(format_period, data["list"][:FORECAST_PERIODS]))
+
 
-    return "\n---\n".join(forecasts)
+async def serve() -> None:
+    """Run the MCP server over stdio, closing the shared client on shutdown."""
+    # FastMCP 1.2.0 has no lifespan hook, so cleanup wraps the stdio loop instead
+    try:
+        await mcp.run_stdio_async()
+    finally:
+        await _close_client()
 
 
 if __name__ == "__main__":
-    mcp.run(transport='stdio')
+    asyncio.run(serve())